@@ -0,0 +1,264 @@
+"""
+Stream an object from acacia into a fifo, adapting the part size and the number of parts we
+request at once to the throughput we see and how fast the consumer reads the fifo.
+
+A fixed chunk size is wrong for some mix of acacia load, object size, and consumer. A fast consumer
+(e.g. consume_file in simple_streaming.py) keeps the pipe empty, so we should fetch more in parallel,
+while a slow consumer (e.g. building the mp.Aligner index in human_mappy.py) blocks our writes, and
+fetching more just fills memory.
+
+We use AIMD (additive increase, multiplicative decrease):
+ - if the consumer is blocking us (backpressure) we halve the number of requests in flight and the part size
+ - if the throughput dropped, we halve the number of requests in flight and the part size
+ - otherwise we add one more request in flight, and grow the part size by min_part_size, up to the limits
+
+Memory is bounded by max_concurrency * max_part_size.
+
+We open the fifo before we make any requests, so the consumer's open() never waits for a writer that
+has already failed, and each part is retried a few times. Whatever goes wrong, the fifo is closed and the
+consumer sees the end of the file, so it can't tell a complete stream from a failed one. Run the writer in
+its own process and use writer_failed() to check it.
+
+You can use this on its own, e.g.
+
+python examples/adaptive_stream.py -o databases/human/chr1.fna.gz -f /tmp/chr1.fifo -v
+
+or import stream_to_fifo from the other examples.
+"""
+
+import io
+import os
+import sys
+import stat
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+__author__ = 'Rob Edwards'
+
+MB = 1024 * 1024
+
+
+class AIMDController:
+    """
+    Decide the part size and the number of requests in flight from the live throughput and backpressure
+    """
+
+    def __init__(self, min_part_size=1 * MB, max_part_size=64 * MB, min_concurrency=1, max_concurrency=16,
+                 window=2.0, backpressure=0.5, drop=0.8, verbose=False):
+        """
+        :param min_part_size: the smallest part we request
+        :param max_part_size: the largest part we request
+        :param min_concurrency: the fewest requests in flight
+        :param max_concurrency: the most requests in flight
+        :param window: the number of seconds between decisions
+        :param backpressure: the fraction of the window we can spend blocked writing to the consumer before we back off
+        :param drop: back off if the throughput falls below this fraction of the last window
+        :param verbose: log the decisions
+        """
+        if not 0 < min_part_size <= max_part_size:
+            raise ValueError(f"Need 0 < min_part_size ({min_part_size}) <= max_part_size ({max_part_size})")
+        if not 0 < min_concurrency <= max_concurrency:
+            raise ValueError(f"Need 0 < min_concurrency ({min_concurrency}) <= max_concurrency ({max_concurrency})")
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.window = window
+        self.backpressure = backpressure
+        self.drop = drop
+        self.verbose = verbose
+
+        self.part_size = min_part_size
+        self.concurrency = min_concurrency
+        self.last_throughput = None
+        self._start = time.monotonic()
+        self._bytes = 0
+        self._blocked = 0.0
+
+    def record(self, nbytes, blocked):
+        """
+        Record one part written to the consumer, and update the settings if the window has passed
+        :param nbytes: the number of bytes we wrote
+        :param blocked: the number of seconds we were blocked writing them
+        """
+        self._bytes += nbytes
+        self._blocked += blocked
+        elapsed = time.monotonic() - self._start
+        if elapsed >= self.window:
+            self.update(self._bytes / elapsed, self._blocked / elapsed)
+            self._start = time.monotonic()
+            self._bytes = 0
+            self._blocked = 0.0
+
+    def update(self, throughput, blocked):
+        """
+        Make a decision at the end of a window
+        :param throughput: the bytes per second we wrote in this window
+        :param blocked: the fraction of this window we spent blocked writing to the consumer
+        """
+        if blocked > self.backpressure:
+            reason = f"consumer backpressure ({blocked:.0%} blocked)"
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.part_size = max(self.min_part_size, self.part_size // 2)
+        elif self.last_throughput and throughput < self.drop * self.last_throughput:
+            reason = f"throughput dropped from {self.last_throughput / MB:.1f} MB/s"
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.part_size = max(self.min_part_size, self.part_size // 2)
+        else:
+            reason = "throughput held"
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.part_size = min(self.max_part_size, self.part_size + self.min_part_size)
+        self.last_throughput = throughput
+
+        if self.verbose:
+            print(f"AIMD: {throughput / MB:.1f} MB/s, {reason}: part size {self.part_size / MB:g} MB, " +
+                  f"{self.concurrency} requests in flight", file=sys.stderr)
+
+
+def fetch_part(s3_client, bucket_name, key, start, end, retries=5):
+    """
+    Get one byte range of an object, retrying with a backoff if the request or the read fails
+    :param s3_client: the connection to s3
+    :param bucket_name: the bucket
+    :param key: the object
+    :param start: the first byte
+    :param end: the last byte (inclusive)
+    :param retries: the number of times to try before we give up
+    :return: the bytes
+    """
+    for attempt in range(retries):
+        try:
+            data = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}")['Body'].read()
+            if len(data) != end - start + 1:
+                raise IOError(f"expected {end - start + 1} bytes but got {len(data)}")
+            return data
+        except Exception as e:
+            if attempt == retries - 1:
+                raise IOError(f"Failed to get bytes {start}-{end} of {bucket_name}/{key} after {retries} tries: {e}")
+            print(f"Retrying bytes {start}-{end} of {bucket_name}/{key}: {e}", file=sys.stderr)
+            time.sleep(2 ** attempt)
+
+
+def open_fifo(fifo: str):
+    """
+    Open a fifo (or a regular file) to write to. A fifo is opened write only, so this waits
+    until the consumer opens it for reading, and when we close it the consumer sees the end of the file.
+    :param fifo: the fifo (or file) to write to
+    :return: a binary file object
+    """
+    if stat.S_ISFIFO(os.stat(fifo).st_mode):
+        fd = os.open(fifo, os.O_WRONLY)
+    else:
+        fd = os.open(fifo, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    return io.FileIO(fd, 'wb')
+
+
+def stream_to_file(s3_client, objectname: str, f, controller: AIMDController = None, verbose=False):
+    """
+    Stream an object to an open file in parts, keeping controller.concurrency parts in flight, and writing them in order
+    :param s3_client: the connection to s3
+    :param objectname: the bucket and object, e.g. databases/human/chr1.fna.gz
+    :param f: the binary file object to write to, e.g. from open_fifo()
+    :param controller: the AIMDController. We make one with the default limits if this is None
+    :param verbose: more output
+    :return: the number of bytes written
+    """
+
+    bucket_name, wanted = objectname.split('/', 1)
+    if controller is None:
+        controller = AIMDController(verbose=verbose)
+    size = s3_client.head_object(Bucket=bucket_name, Key=wanted)['ContentLength']
+    if verbose:
+        print(f"Streaming {size} bytes from {objectname}", file=sys.stderr)
+
+    offset = 0
+    written = 0
+    pending = deque()
+
+    def refill():
+        nonlocal offset
+        while offset < size and len(pending) < controller.concurrency:
+            end = min(offset + controller.part_size, size) - 1
+            pending.append(executor.submit(fetch_part, s3_client, bucket_name, wanted, offset, end))
+            offset = end + 1
+
+    with ThreadPoolExecutor(max_workers=controller.max_concurrency) as executor:
+        refill()
+        while pending:
+            data = pending.popleft().result()
+            # top up before we write, so the next parts are fetched while the consumer drains this one
+            refill()
+            start = time.monotonic()
+            f.write(data)
+            controller.record(len(data), time.monotonic() - start)
+            written += len(data)
+
+    return written
+
+
+def stream_to_fifo(s3_client, objectname: str, fifo: str, controller: AIMDController = None, verbose=False):
+    """
+    Open a fifo (or file), and then stream an object to it with stream_to_file
+    :param s3_client: the connection to s3
+    :param objectname: the bucket and object, e.g. databases/human/chr1.fna.gz
+    :param fifo: the fifo (or file) to write to
+    :param controller: the AIMDController. We make one with the default limits if this is None
+    :param verbose: more output
+    :return: the number of bytes written
+    """
+    with open_fifo(fifo) as f:
+        if verbose:
+            print(f"Opened {fifo} for writing", file=sys.stderr)
+        return stream_to_file(s3_client, objectname, f, controller, verbose)
+
+
+def writer_failed(writeprocess, objectname: str, reader=None, timeout=None) -> bool:
+    """
+    Wait for a process writing a fifo and check that it streamed the whole object. The consumer sees
+    the end of the file whether the stream finished or failed, so this is the only way to know.
+    If the writer failed, or is still running after timeout seconds, we terminate it and the reader.
+    :param writeprocess: the Process writing the fifo
+    :param objectname: the object it is streaming, for the error message
+    :param reader: the Process reading the fifo, if there is one
+    :param timeout: the number of seconds to wait for the writer (None waits forever)
+    :return: True if the writer failed
+    """
+    writeprocess.join(timeout)
+    if writeprocess.exitcode == 0:
+        return False
+    if writeprocess.exitcode is None:
+        print(f"ERROR: still streaming {objectname} after {timeout} seconds. Stopping it", file=sys.stderr)
+        writeprocess.terminate()
+        writeprocess.join()
+    else:
+        print(f"ERROR: streaming {objectname} failed with exit code {writeprocess.exitcode}", file=sys.stderr)
+    if reader is not None and reader.is_alive():
+        reader.terminate()
+        reader.join()
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream an object into a fifo, adapting the part size and concurrency')
+    parser.add_argument('-o', help='object name on acacia (including bucket)', required=True)
+    parser.add_argument('-f', help='fifo to write to (we create it if it does not exist)', required=True)
+    parser.add_argument('--min-part', help='minimum part size in MB (default: 1)', type=int, default=1)
+    parser.add_argument('--max-part', help='maximum part size in MB (default: 64)', type=int, default=64)
+    parser.add_argument('--max-streams', help='maximum requests in flight (default: 16)', type=int, default=16)
+    parser.add_argument('-v', help='verbose output', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.f):
+        os.mkfifo(args.f)
+
+    session = boto3.session.Session()
+    s3_client = session.client(
+        service_name='s3',
+        endpoint_url='https://projects.pawsey.org.au',
+    )
+    aimd = AIMDController(min_part_size=args.min_part * MB, max_part_size=args.max_part * MB,
+                          max_concurrency=args.max_streams, verbose=args.v)
+    stream_to_fifo(s3_client, args.o, args.f, aimd, args.v)
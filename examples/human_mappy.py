@@ -7,6 +7,21 @@ Basic approach:
  - we find and stream the human genome from acacia in one thread
  - we read that in another thread and process the data
 
+Optionally, we accumulate coverage and mapping statistics while we map, so you don't need a second
+pass over the PAF output. Use -s to provide an output prefix, and we write:
+ - <prefix>.coverage.npz  binned coverage (mean depth per bin) for each contig, and the MAPQ histogram
+ - <prefix>.contigs.tsv   per contig length, number of reads, bases aligned, mean depth, and fraction of bins covered
+ - <prefix>.summary.tsv   mapped and unmapped read counts
+The bin size (-b) bounds the memory we need for the coverage arrays.
+
+Server mode (-j) loads or builds the index once in this process, and then forks a pool of workers (-p) that
+share the index copy-on-write, so each extra mapping job needs almost no memory and starts straight away.
+The jobs are read one per line from the -j file (use - for stdin, or a named pipe to keep the server running):
+    reads.fq<tab>output.paf[<tab>stats prefix]
+If the output is omitted we write reads.fq.paf. With a named pipe the server keeps waiting for more jobs
+after each client closes the pipe, until it reads a line with just STOP, e.g.
+    echo STOP > jobs.fifo
+
 Human genome target:
     At the moment you can either use:
      - databases/human/chr1.fna.gz
@@ -16,17 +31,23 @@ Human genome target:
 import os
 import io
 import sys
+import stat
+import shutil
+import tempfile
 import argparse
 import boto3
 import mappy as mp
-from multiprocessing import Process
+import numpy as np
+from multiprocessing import Process, get_context
+from adaptive_stream import open_fifo, stream_to_file, writer_failed
 
 __author__ = 'Rob Edwards'
 
 
-def get_human_genome(location, verbose=False):
+def connect_to_genome(location, verbose=False):
     """
-    Get the human genome
+    Connect to acacia and check that the human genome is there
+    :return: the s3 client
     """
 
     bucket_name, wanted = location.split('/', 1)
@@ -50,25 +71,149 @@ def get_human_genome(location, verbose=False):
         if obj['Key'] == wanted:
             if verbose:
                 print(f"Streaming {wanted}", file=sys.stderr)
-            return s3_client.get_object(Bucket=bucket_name, Key=wanted)['Body']
+            return s3_client
+
+    print(f"Sorry, {wanted} not found in {bucket_name}", file=sys.stderr)
+    sys.exit(2)
 
 
 def write_the_genome(human_genome, fifo, verbose=False):
     """
-    A function to write the genome
+    A function to write the genome. stream_to_file adapts the part size and the number of parts
+    in flight to how fast the aligner reads the fifo.
+    We open the fifo before we connect, so if we can't find the genome the aligner sees the end of
+    the file rather than waiting for us forever
     """
-    stream = get_human_genome(human_genome, verbose=verbose)
-    #fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
-    fd = os.open(fifo, os.O_RDWR)
-    if verbose:
-        print(f"File descriptor {fd} for {fifo}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
-    with io.FileIO(fd, 'wb') as f:
-        f.write(stream.read())
+    with open_fifo(fifo) as f:
+        if verbose:
+            print(f"Writing to {fifo}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
+        s3_client = connect_to_genome(human_genome, verbose=verbose)
+        stream_to_file(s3_client, human_genome, f, verbose=verbose)
 
 
-def read_genome(fifo, reads, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, out_cs=False, verbose=False):
+class MappingStats:
     """
-    Read the genome from the fifo and return the alignment object
+    Accumulate coverage and mapping statistics from the mp.Alignment hits as we map the reads.
+
+    Coverage is binned so that the memory is bounded by genome length / bin_size.
+    The coverage includes all the primary alignments (mappy also marks supplementary alignments as primary,
+    so a chimeric read covers each of its segments), but the reads per contig and the MAPQ histogram only
+    use the best primary alignment so each read contributes once.
+    """
+
+    def __init__(self, bin_size=1000, contigs=None):
+        """
+        :param bin_size: the number of bp in each coverage bin
+        :param contigs: a dict of contig name and length, so contigs with no reads are still reported
+        """
+        if bin_size < 1:
+            raise ValueError(f"bin_size must be a positive integer, not {bin_size}")
+        self.bin_size = bin_size
+        self.contig_lengths = {}
+        self.coverage = {}
+        self.contig_reads = {}
+        self.mapq = np.zeros(256, dtype=np.int64)
+        self.mapped = 0
+        self.unmapped = 0
+        for name, length in (contigs or {}).items():
+            self._contig(name, length)
+
+    def _contig(self, name, length):
+        """
+        Get the coverage array for a contig, creating it the first time we see the contig
+        """
+        if name not in self.coverage:
+            self.contig_lengths[name] = length
+            self.coverage[name] = np.zeros((length + self.bin_size - 1) // self.bin_size, dtype=np.int64)
+            self.contig_reads.setdefault(name, 0)
+        return self.coverage[name]
+
+    def add_read(self, hits):
+        """
+        Add all the hits for one read
+        :param hits: the list of mp.Alignment objects for this read
+        """
+        primary = [h for h in hits if h.is_primary]
+        if not primary:
+            self.unmapped += 1
+            return
+        self.mapped += 1
+        best = max(primary, key=lambda h: (h.mapq, h.blen))
+        self.contig_reads[best.ctg] = self.contig_reads.get(best.ctg, 0) + 1
+        self.mapq[min(best.mapq, 255)] += 1
+        for h in primary:
+            self.add_hit(h)
+
+    def add_hit(self, h):
+        """
+        Add the aligned bases of one hit to the coverage bins for its contig
+        :param h: the mp.Alignment object
+        """
+        cov = self._contig(h.ctg, h.ctg_len)
+        if h.r_en <= h.r_st:
+            return
+        bins = np.arange(h.r_st // self.bin_size, (h.r_en - 1) // self.bin_size + 1)
+        starts = np.maximum(bins * self.bin_size, h.r_st)
+        ends = np.minimum((bins + 1) * self.bin_size, h.r_en)
+        cov[bins] += ends - starts
+
+    def depth(self, name):
+        """
+        The mean depth in each bin for a contig. The last bin may be shorter than bin_size
+        """
+        length = self.contig_lengths[name]
+        binlen = np.full(len(self.coverage[name]), self.bin_size, dtype=np.float64)
+        binlen[-1] = length - (len(binlen) - 1) * self.bin_size
+        return self.coverage[name] / binlen
+
+    def write(self, prefix, verbose=False):
+        """
+        Write the npz and tsv summaries
+        :param prefix: the output prefix
+        :param verbose: more output
+        """
+        arrays = {f"depth:{name}": self.depth(name) for name in self.coverage}
+        np.savez_compressed(f"{prefix}.coverage.npz", bin_size=np.array(self.bin_size), mapq=self.mapq, **arrays)
+
+        with open(f"{prefix}.contigs.tsv", 'w') as out:
+            print("contig\tlength\treads\taligned_bases\tmean_depth\tfraction_bins_covered", file=out)
+            for name in sorted(self.coverage):
+                cov = self.coverage[name]
+                aligned = int(cov.sum())
+                print(f"{name}\t{self.contig_lengths[name]}\t{self.contig_reads[name]}\t{aligned}\t" +
+                      f"{aligned / self.contig_lengths[name]:.4f}\t{np.count_nonzero(cov) / len(cov):.4f}", file=out)
+
+        total = self.mapped + self.unmapped
+        with open(f"{prefix}.summary.tsv", 'w') as out:
+            print(f"reads\t{total}", file=out)
+            print(f"mapped\t{self.mapped}", file=out)
+            print(f"unmapped\t{self.unmapped}", file=out)
+            print(f"fraction_mapped\t{self.mapped / total if total else 0:.4f}", file=out)
+
+        if verbose:
+            print(f"Wrote coverage and mapping statistics to {prefix}.*", file=sys.stderr)
+
+
+def contig_lengths(a):
+    """
+    Get the length of every contig in the index. An index built without the sequences (e.g. a .mmi
+    made with minimap2 -d and no sequences) can't tell us, so those contigs are added when we see a hit
+    :param a: the mp.Aligner
+    :return: a dict of contig name and length
+    """
+    contigs = {}
+    for name in a.seq_names:
+        seq = a.seq(name)
+        if seq is not None:
+            contigs[name] = len(seq)
+    return contigs
+
+
+def read_genome(fifo, reads, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, out_cs=False,
+                stats_prefix=None, bin_size=1000, verbose=False):
+    """
+    Read the genome from the fifo and return the alignment object.
+    If stats_prefix is set we also accumulate coverage and mapping statistics and write them at the end.
     """
     if verbose:
         print(f"Aligning my PID: {os.getpid()} Parent PD {os.getppid()}", file=sys.stderr)
@@ -76,13 +221,37 @@ def read_genome(fifo, reads, preset, min_cnt=None, min_sc=None, k=None, w=None,
     a = mp.Aligner(fifo, preset=preset, min_cnt=min_cnt, min_chain_score=min_sc, k=k, w=w, bw=bw)
     if not a:
         raise Exception("ERROR: failed to load/build index file for the human genome")
+    map_reads(a, reads, out_cs=out_cs, stats_prefix=stats_prefix, bin_size=bin_size, verbose=verbose)
+
+
+def map_reads(a, reads, out=sys.stdout, out_cs=False, stats_prefix=None, bin_size=1000, contigs=None, verbose=False):
+    """
+    Map the reads against an aligner and print the hits in PAF format
+    :param a: the mp.Aligner
+    :param reads: the fastx file of reads
+    :param out: the file handle to write the PAF to
+    :param out_cs: output the cs tag
+    :param stats_prefix: if set, accumulate coverage and mapping statistics and write them here
+    :param bin_size: the bin size for the coverage statistics
+    :param contigs: the contig lengths from contig_lengths(a). We look them up if this is None
+    :param verbose: more output
+    """
+    stats = None
+    if stats_prefix:
+        stats = MappingStats(bin_size, contigs if contigs is not None else contig_lengths(a))
     for name, seq, qual in mp.fastx_read(reads):  # read one sequence
         # print(name)
-        for h in a.map(seq, cs=out_cs):  # traverse hits
-            print('{}\t{}\t{}'.format(name, len(seq), h))
+        hits = list(a.map(seq, cs=out_cs))
+        for h in hits:  # traverse hits
+            print('{}\t{}\t{}'.format(name, len(seq), h), file=out)
+        if stats:
+            stats.add_read(hits)
+    if stats:
+        stats.write(stats_prefix, verbose=verbose)
 
 
-def read_align(genome, reads, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, out_cs=False, verbose=False):
+def read_align(genome, reads, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, out_cs=False,
+               stats_prefix=None, bin_size=1000, verbose=False):
 
     # here we create a fifo object that we can pass to the mp.Aligner
     fifo_filename = f'/home/edwa0468/scratch/tmp/tmp.{os.getpid()}.fna.gz'
@@ -94,14 +263,16 @@ def read_align(genome, reads, preset, min_cnt=None, min_sc=None, k=None, w=None,
         print(f"Our FIFO is at {fifo_filename}", file=sys.stderr)
     
     # start the process to read the genome from the pipe
-    readprocess = Process(target=read_genome, args=(fifo_filename, reads, preset, min_cnt, min_sc, k, w, bw, out_cs, verbose,))
+    readprocess = Process(target=read_genome, args=(fifo_filename, reads, preset, min_cnt, min_sc, k, w, bw, out_cs,
+                                                       stats_prefix, bin_size, verbose,))
     readprocess.start()
 
     # start the process to write the genome to the pipe
     writeprocess = Process(target=write_the_genome, args=(genome, fifo_filename, verbose,))
     writeprocess.start()
-    writeprocess.join()
-    
+    if writer_failed(writeprocess, genome, readprocess):
+        os.unlink(fifo_filename)
+        sys.exit(2)
 
     # wait until reading is done
     readprocess.join()
@@ -109,9 +280,129 @@ def read_align(genome, reads, preset, min_cnt=None, min_sc=None, k=None, w=None,
     os.unlink(fifo_filename)
 
 
+def map_worker(a, jobs, out_cs=False, bin_size=1000, contigs=None, verbose=False, failures=None):
+    """
+    A worker in the mapping pool. The aligner is inherited from the parent when we fork, so we
+    don't copy it, we just take jobs from the queue until we get None
+    :param a: the mp.Aligner built by the parent
+    :param jobs: the queue of (reads, paf, stats_prefix) jobs
+    :param out_cs: output the cs tag
+    :param bin_size: the bin size for the coverage statistics
+    :param contigs: the contig lengths from contig_lengths(a)
+    :param verbose: more output
+    :param failures: a shared counter of the jobs that failed
+    """
+    for reads, paf, stats_prefix in iter(jobs.get, None):
+        if verbose:
+            print(f"Worker {os.getpid()} mapping {reads} to {paf}", file=sys.stderr)
+        # one bad job (e.g. a missing reads file) should not take the worker down with it
+        try:
+            with open(paf, 'w') as out:
+                map_reads(a, reads, out=out, out_cs=out_cs, stats_prefix=stats_prefix, bin_size=bin_size,
+                          contigs=contigs, verbose=verbose)
+        except Exception as e:
+            print(f"ERROR: worker {os.getpid()} failed to map {reads} to {paf}: {e}", file=sys.stderr)
+            if failures is not None:
+                with failures.get_lock():
+                    failures.value += 1
+
+
+def read_jobs(jobfile):
+    """
+    Read the mapping jobs, one per line: reads<tab>output.paf[<tab>stats prefix]
+    We stop at the end of the file, or at a line with just STOP.
+    A named pipe is opened read/write, so we are also a writer and never see the end of the file
+    when a client closes it. We keep waiting for more jobs until we get STOP.
+    :param jobfile: the file (or named pipe) with the jobs. Use - for stdin
+    """
+    if jobfile == '-':
+        f = sys.stdin
+    elif stat.S_ISFIFO(os.stat(jobfile).st_mode):
+        f = io.TextIOWrapper(io.FileIO(os.open(jobfile, os.O_RDWR), 'r'))
+    else:
+        f = open(jobfile, 'r')
+
+    try:
+        for l in f:
+            p = l.rstrip('\n').split('\t')
+            if p[0] == 'STOP':
+                return
+            if not p[0]:
+                continue
+            paf = p[1] if len(p) > 1 and p[1] else f"{p[0]}.paf"
+            stats_prefix = p[2] if len(p) > 2 and p[2] else None
+            yield p[0], paf, stats_prefix
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def load_aligner(genome, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, verbose=False):
+    """
+    Load or build the index in this process. If genome is a local file (e.g. a .mmi index) we read it
+    directly, otherwise we stream it from acacia through a fifo in a new temporary directory
+    """
+    if os.path.exists(genome):
+        a = mp.Aligner(genome, preset=preset, min_cnt=min_cnt, min_chain_score=min_sc, k=k, w=w, bw=bw)
+    else:
+        fifodir = tempfile.mkdtemp(prefix='human_mappy.')
+        fifo_filename = os.path.join(fifodir, 'genome.fna.gz')
+        os.mkfifo(fifo_filename)
+        try:
+            writeprocess = Process(target=write_the_genome, args=(genome, fifo_filename, verbose,))
+            writeprocess.start()
+            a = mp.Aligner(fifo_filename, preset=preset, min_cnt=min_cnt, min_chain_score=min_sc, k=k, w=w, bw=bw)
+            if writer_failed(writeprocess, genome):
+                raise Exception(f"ERROR: streaming {genome} failed. Not serving a partial index")
+        finally:
+            shutil.rmtree(fifodir, ignore_errors=True)
+    if not a:
+        raise Exception("ERROR: failed to load/build index file for the human genome")
+    return a
+
+
+def serve(genome, jobfile, processes, preset, min_cnt=None, min_sc=None, k=None, w=None, bw=None, out_cs=False,
+          bin_size=1000, verbose=False):
+    """
+    Build the index once, and then fork a pool of workers that share it copy-on-write and map
+    the jobs from jobfile
+    :return: the number of jobs and workers that failed
+    """
+    a = load_aligner(genome, preset, min_cnt, min_sc, k, w, bw, verbose)
+    if verbose:
+        print(f"Index loaded in {os.getpid()}. Starting {processes} workers", file=sys.stderr)
+
+    contigs = contig_lengths(a)
+
+    # we need fork (not spawn) so the workers inherit the index rather than pickling it
+    ctx = get_context('fork')
+    jobs = ctx.Queue()
+    failures = ctx.Value('i', 0)
+    workers = [ctx.Process(target=map_worker, args=(a, jobs, out_cs, bin_size, contigs, verbose, failures,))
+               for _ in range(processes)]
+    for p in workers:
+        p.start()
+
+    for job in read_jobs(jobfile):
+        jobs.put(job)
+    for _ in workers:
+        jobs.put(None)
+    for p in workers:
+        p.join()
+        if p.exitcode != 0:
+            print(f"ERROR: worker {p.pid} exited with {p.exitcode}", file=sys.stderr)
+            with failures.get_lock():
+                failures.value += 1
+
+    # if a worker died, its jobs are still in the queue. Don't wait to flush them when we exit
+    jobs.close()
+    jobs.cancel_join_thread()
+    return failures.value
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Usage: human_mappy.py [options] <ref.fa>|<ref.mmi> <query.fq>')
-    parser.add_argument('-f', help='input file', required=True)
+    parser.add_argument('-f', help='input file')
     parser.add_argument('-g', help='human genome', required=True)
     parser.add_argument('-x', help='preset: sr, map-pb, map-ont, asm5, asm10 or splice', default='sr')
     parser.add_argument('-n', help='mininum number of minimizers', type=int)
@@ -120,8 +411,26 @@ if __name__ == "__main__":
     parser.add_argument('-w', help='minimizer window length', type=int)
     parser.add_argument('-r', help='band width', type=int)
     parser.add_argument('-c', help='output the cs tag', action='store_true')
+    parser.add_argument('-s', help='prefix for coverage and mapping statistics (npz and tsv)')
+    parser.add_argument('-b', help='bin size for the coverage statistics (default: 1000)', type=int, default=1000)
+    parser.add_argument('-j', help='server mode: file or named pipe of jobs, one per line (- for stdin)')
+    parser.add_argument('-p', help='number of worker processes in server mode (default: 4)', type=int, default=4)
     parser.add_argument('-v', help='verbose output', action='store_true')
     args = parser.parse_args()
 
+    if args.j:
+        if args.f or args.s:
+            parser.error('-f and -s are not used with -j. Put the reads and stats prefix on each job line')
+        failed = serve(genome=args.g, jobfile=args.j, processes=args.p, preset=args.x, min_cnt=args.n,
+                       min_sc=args.m, k=args.k, w=args.w, bw=args.r, out_cs=args.c, bin_size=args.b,
+                       verbose=args.v)
+        if failed:
+            print(f"ERROR: {failed} jobs or workers failed", file=sys.stderr)
+            sys.exit(2)
+        sys.exit(0)
+
+    if not args.f:
+        parser.error('one of -f or -j is required')
+
     read_align(genome=args.g, reads=args.f, preset=args.x, min_cnt=args.n, min_sc=args.m, k=args.k, w=args.w,
-               bw=args.r, out_cs=args.c, verbose=args.v)
+               bw=args.r, out_cs=args.c, stats_prefix=args.s, bin_size=args.b, verbose=args.v)
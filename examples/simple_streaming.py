@@ -11,12 +11,12 @@ example to error check the stream
 We also have a consumer process, which just counts words in the file
 """
 
-import io
 import os
 import sys
 import argparse
 import boto3
 from multiprocessing import Process
+from adaptive_stream import stream_to_fifo, writer_failed
 __author__ = 'Rob Edwards'
 
 
@@ -39,14 +39,10 @@ def stream_from_accia(object:str, fifo:str, verbose:bool=False):
         endpoint_url='https://projects.pawsey.org.au',
     )
 
-    stream = s3_client.get_object(Bucket=bucket_name, Key=wanted)['Body']
-
-    # open the fio object
-    fd = os.open(fifo, os.O_RDWR)
+    # stream in parts, adapting the part size and the parts in flight to how fast consume_file reads
     if verbose:
-        print(f"File descriptor {fd} for {fifo}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
-    with io.FileIO(fd, 'w') as f:
-        f.write(stream.read())
+        print(f"Writing {wanted} from {bucket_name} to {fifo}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
+    stream_to_fifo(s3_client, object, fifo, verbose=verbose)
 
 def consume_file(fifo:str, verbose:bool=False):
     """
@@ -89,7 +85,9 @@ def main(objectname:str, verbose=False):
     # start the process to write the genome to the pipe
     writeprocess = Process(target=stream_from_accia, args=(objectname, fifo_filename, verbose,))
     writeprocess.start()
-    writeprocess.join()
+    if writer_failed(writeprocess, objectname, readprocess):
+        os.unlink(fifo_filename)
+        sys.exit(2)
 
     # wait until reading is done
     readprocess.join()
@@ -1,9 +1,24 @@
 """
 A wrapper to run mmseqs_easy_taxonomy using named pipes
+
+Optionally, we convert the tsv outputs (_lca.tsv, _report, _tophit_aln, _tophit_report) to typed,
+compressed parquet files. The conversion streams the tsv files in blocks so the memory is bounded
+regardless of the size of the results, and we can upload the parquet files straight to acacia.
+
+For large metagenomes, we can split the query fasta into shards with about the same number of residues
+(-s), and run one easy-taxonomy per shard at the same time, each with its own tmp directory. The named
+pipes can only be read once, so in this mode we stage the database into the data directory first, and
+all the shards share it. At the end we merge the shard outputs into one set of results.
+
+To use array jobs, stage the database once with --stage, run each task with -s <shards> -i <task id>
+(e.g. -i $SLURM_ARRAY_TASK_ID), and then run once more with -s <shards> --merge when they are all done.
 """
 
 import os
-import io
+import gzip
+import heapq
+import shutil
+import tempfile
 import subprocess
 import sys
 import argparse
@@ -13,6 +28,33 @@ __author__ = 'Rob Edwards'
 
 import boto3
 from botocore.client import BaseClient
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# adaptive_stream.py is shared with the examples, so this expects the repository layout (see the README)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples'))
+from adaptive_stream import AIMDController, stream_to_fifo, writer_failed, MB
+
+# the files that make up an mmseqs database
+DATABASE_FILES = ['', '.dbtype', '.index', '.lookup', '.source', '.version', '_h', '_h.dbtype', '_h.index',
+                  '_mapping', '_taxonomy']
+
+# the columns in the mmseqs easy-taxonomy outputs. Any extra columns (e.g. with --tax-lineage) are read as strings
+OUTPUT_COLUMNS = {
+    '_lca.tsv': [('query', pa.string()), ('taxid', pa.int64()), ('rank', pa.string()), ('name', pa.string()),
+                 ('fragments', pa.int64()), ('assigned', pa.int64()), ('agreeing', pa.int64()),
+                 ('support', pa.float64())],
+    '_report': [('clade_percent', pa.float64()), ('clade_reads', pa.int64()), ('taxon_reads', pa.int64()),
+                ('rank', pa.string()), ('taxid', pa.int64()), ('name', pa.string())],
+    '_tophit_aln': [('query', pa.string()), ('target', pa.string()), ('fident', pa.float64()),
+                    ('alnlen', pa.int64()), ('mismatch', pa.int64()), ('gapopen', pa.int64()),
+                    ('qstart', pa.int64()), ('qend', pa.int64()), ('tstart', pa.int64()), ('tend', pa.int64()),
+                    ('evalue', pa.float64()), ('bits', pa.float64())],
+    '_tophit_report': [('target', pa.string()), ('sequences', pa.int64()), ('unique_coverage', pa.float64()),
+                       ('target_length', pa.int64()), ('average_identity', pa.float64()), ('taxid', pa.int64()),
+                       ('rank', pa.string()), ('name', pa.string())],
+}
 
 
 def get_s3client()->BaseClient:
@@ -42,18 +84,21 @@ def create_a_connection(object:str, namedpipe:str, s3_client:BaseClient, verbose
     bucket_name, wanted = object.split('/', 1)
     #if verbose:
     print(f"Getting {wanted} from {bucket_name}", file=sys.stderr)
-    stream = s3_client.get_object(Bucket=bucket_name, Key=wanted)['Body']
-
-    # open the fio object
-    fd = os.open(namedpipe, os.O_RDWR)
-    if not fd:
-        print(f"Did not connect to {namedpipe}", file=sys.stderr)
-        sys.exit(2)
 
     if verbose:
-        print(f"File descriptor {fd} for {namedpipe}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
-    with io.FileIO(fd, 'w') as f:
-        f.write(stream.read())
+        print(f"Writing to {namedpipe}. From child. Child PID: {os.getpid()} Parent PID: {os.getppid()}", file=sys.stderr)
+    # we stream all the database files at once, so limit the memory each one can use
+    stream_to_fifo(s3_client, object, namedpipe, database_controller(verbose), verbose)
+
+
+def database_controller(verbose=False) -> AIMDController:
+    """
+    The limits for streaming one database file. There are eleven files streaming at the same time,
+    so each one can use at most 4 x 32 MB
+    :param verbose: log the decisions
+    :return: the AIMDController
+    """
+    return AIMDController(max_part_size=32 * MB, max_concurrency=4, verbose=verbose)
 
 def create_connections(bucket:str, database:str, datadir:str, verbose:bool=False):
     """
@@ -66,10 +111,9 @@ def create_connections(bucket:str, database:str, datadir:str, verbose:bool=False
     :return: a dict of process names
     """
 
-    appendices = ['', '.dbtype', '.index', '.lookup', '.source', '.version', '_h', '_h.dbtype', '_h.index', '_mapping', '_taxonomy']
     processes = {}
 
-    for a in appendices:
+    for a in DATABASE_FILES:
         thisname = f"{database}{a}"
         fifo_name = f"{datadir}/{thisname}"
         os.mkfifo(fifo_name)
@@ -87,35 +131,446 @@ def create_connections(bucket:str, database:str, datadir:str, verbose:bool=False
     return processes
 
 
-def run_mmseqs(datadir: str, database: str, fasta: str, outputdir: str, verbose=False):
+def stage_database(bucket: str, database: str, datadir: str, s3_client: BaseClient, verbose: bool = False):
+    """
+    Download the database files into datadir so that more than one mmseqs can read them.
+    We skip files that are already staged, and download to a unique temporary file first so that
+    nothing ever sees a partial file.
+    :param bucket: the path to the data on acacia, eg. databases/mmseqs/UniRef50.20230126
+    :param database: the name of the database, eg. UniRef50
+    :param datadir: the datadirectory to write the files
+    :param s3_client: the connection to s3
+    :param verbose: more output
+    """
+
+    for a in DATABASE_FILES:
+        thisname = f"{database}{a}"
+        filename = f"{datadir}/{thisname}"
+        if os.path.isfile(filename):
+            continue
+        if verbose:
+            print(f"Staging {thisname} to {datadir}", file=sys.stderr)
+        fd, tmpname = tempfile.mkstemp(prefix=f"{thisname}.", suffix='.part', dir=datadir)
+        os.close(fd)
+        try:
+            stream_to_fifo(s3_client, f"{bucket}/{thisname}", tmpname, database_controller(verbose), verbose)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+        os.replace(tmpname, filename)
+
+
+def database_staged(database: str, datadir: str) -> bool:
+    """
+    Are all the database files staged in datadir?
+    :param database: the name of the database, eg. UniRef50
+    :param datadir: the datadirectory with the files
+    :return: True if they are all there
+    """
+    return all(os.path.isfile(f"{datadir}/{database}{a}") for a in DATABASE_FILES)
+
+
+def read_fasta(fasta: str):
+    """
+    Read a fasta file one sequence at a time
+    :param fasta: the fasta file (can be gzipped)
+    :return: a generator of (header line, list of sequence lines, number of residues)
+    """
+
+    header = None
+    lines = []
+    residues = 0
+    with (gzip.open(fasta, 'rt') if fasta.endswith('.gz') else open(fasta, 'r')) as f:
+        for l in f:
+            if l.startswith('>'):
+                if header is not None:
+                    yield header, lines, residues
+                header = l
+                lines = []
+                residues = 0
+            elif header is not None:
+                lines.append(l)
+                residues += len(l.strip())
+    if header is not None:
+        yield header, lines, residues
+
+
+def split_fasta(fasta: str, shards: int, sharddir: str, only: int = None, verbose=False):
+    """
+    Split a fasta file into shards with about the same total number of residues. We assign the
+    longest sequences first, each to the shard with the fewest residues. The assignment is
+    deterministic, so array tasks can each write just their own shard.
+    If there are fewer sequences than shards we make fewer shards. The shards we made are
+    recorded in {sharddir}/manifest.tsv, which merge_shards reads.
+    :param fasta: the fasta file to split
+    :param shards: the number of shards
+    :param sharddir: the directory to write the shards to
+    :param only: only write this shard
+    :param verbose: more output
+    :return: a list of the shard fasta files
+    """
+
+    lengths = [residues for _, _, residues in read_fasta(fasta)]
+    shards = max(1, min(shards, len(lengths)))
+    assignment = [0] * len(lengths)
+    heap = [(0, i) for i in range(shards)]
+    for seqid in sorted(range(len(lengths)), key=lambda x: -lengths[x]):
+        total, shard = heapq.heappop(heap)
+        assignment[seqid] = shard
+        heapq.heappush(heap, (total + lengths[seqid], shard))
+    if verbose:
+        for total, shard in sorted(heap, key=lambda x: x[1]):
+            print(f"Shard {shard} has {total} residues", file=sys.stderr)
+
+    # every array task writes the same manifest, so write it to a temporary file and move it into place
+    os.makedirs(sharddir, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(prefix='manifest.', dir=sharddir)
+    with os.fdopen(fd, 'w') as out:
+        print("shard\tresidues", file=out)
+        for total, shard in sorted(heap, key=lambda x: x[1]):
+            print(f"{shard}\t{total}", file=out)
+    os.replace(tmpname, f"{sharddir}/manifest.tsv")
+
+    shardfiles = [f"{sharddir}/shard_{i}.fasta" for i in range(shards)]
+    if only is not None and only >= shards:
+        return shardfiles
+    wanted = range(shards) if only is None else [only]
+    outs = {i: open(shardfiles[i], 'w') for i in wanted}
+    for seqid, (header, lines, _) in enumerate(read_fasta(fasta)):
+        if assignment[seqid] in outs:
+            outs[assignment[seqid]].write(header)
+            outs[assignment[seqid]].writelines(lines)
+    for out in outs.values():
+        out.close()
+    return shardfiles
+
+
+def run_mmseqs(datadir: str, database: str, fasta: str, outputdir: str, threads: int = 8,
+               tmpdir: str = "/home/edwa0468/scratch/tmp/", verbose=False):
     """
     Launch and run mmseqs
     :param datadir: the directory with the mmseqs named pipes
     :param database: the name of the database
     :param outputdir: the directory for the results
     :param fasta: the fasta file
+    :param threads: the number of threads for mmseqs
+    :param tmpdir: the tmp directory for mmseqs
     :param verbose: more output
     :return:
     """
 
     # mmseqs easy-taxonomy $FASTA $BGFS/$DB/$DB $BGFS/output/$TMPOUTPUT $(mktemp -d -p $BGFS) --start-sens 1 --sens-steps 3 -s 7 --threads 32
-    mmseqs_command = ['mmseqs', 'easy-taxonomy', fasta, f"{datadir}/{database}", outputdir, "/home/edwa0468/scratch/tmp/", '--threads', '8']
+    mmseqs_command = ['mmseqs', 'easy-taxonomy', fasta, f"{datadir}/{database}", outputdir, tmpdir, '--threads', str(threads)]
     if verbose:
         print(f'Forking mmseqs in child {os.getpid()}', file=sys.stderr)
-    subprocess.run(mmseqs_command)
+    subprocess.run(mmseqs_command, check=True)
+
+def run_shards(datadir: str, database: str, shardfiles: list, outputdir: str, threads: int = 8,
+               tmpdir: str = "/home/edwa0468/scratch/tmp/", only: int = None, verbose=False):
+    """
+    Run one mmseqs easy-taxonomy per shard at the same time, each with its own tmp directory.
+    We remove any old outputs for a shard before we start it, and write {prefix}.done when it succeeds,
+    so merge_shards never merges stale or failed results.
+    :param datadir: the directory with the staged database
+    :param database: the name of the database
+    :param shardfiles: the list of shard fasta files
+    :param outputdir: the output prefix. Each shard writes to {outputdir}_shards/shard_{i}
+    :param threads: the number of threads for each mmseqs
+    :param tmpdir: the directory to make the tmp directories in
+    :param only: only run this shard
+    :param verbose: more output
+    :return: a list of the shards that failed
+    """
+
+    processes = {}
+    tmpdirs = []
+    for i, shardfile in enumerate(shardfiles):
+        if only is not None and i != only:
+            continue
+        prefix = f"{outputdir}_shards/shard_{i}"
+        for suffix in ['.done'] + list(OUTPUT_COLUMNS):
+            if os.path.exists(f"{prefix}{suffix}"):
+                os.unlink(f"{prefix}{suffix}")
+        shardtmp = tempfile.mkdtemp(prefix=f"shard_{i}.", dir=tmpdir)
+        tmpdirs.append(shardtmp)
+        p = Process(target=run_mmseqs, args=(datadir, database, shardfile, prefix, threads, shardtmp, verbose,))
+        if verbose:
+            print(f"Starting mmseqs for {shardfile}", file=sys.stderr)
+        p.start()
+        processes[i] = p
+
+    failed = []
+    for i, p in processes.items():
+        p.join()
+        if p.exitcode == 0:
+            open(f"{outputdir}_shards/shard_{i}.done", 'w').close()
+        else:
+            print(f"ERROR: mmseqs for shard {i} exited with {p.exitcode}", file=sys.stderr)
+            failed.append(i)
+    for t in tmpdirs:
+        shutil.rmtree(t, ignore_errors=True)
+    return failed
+
+
+def merge_report(reports: list, outfile: str):
+    """
+    Merge kraken style mmseqs reports. The names are indented two spaces per level, so we rebuild
+    the tree from each report, sum the reads, and write it out again with the children sorted by reads.
+    :param reports: the list of report files
+    :param outfile: the merged report
+    """
+
+    taxa = {}
+    children = {}
+    for report in reports:
+        stack = []
+        with open(report, 'r') as f:
+            for l in f:
+                p = l.rstrip('\n').split('\t')
+                if len(p) < 6:
+                    continue
+                taxid = p[4]
+                depth = (len(p[5]) - len(p[5].lstrip(' '))) // 2
+                if taxid not in taxa:
+                    taxa[taxid] = {'clade': 0, 'taxon': 0, 'rank': p[3], 'name': p[5].strip(), 'depth': depth}
+                taxa[taxid]['clade'] += int(p[1])
+                taxa[taxid]['taxon'] += int(p[2])
+                del stack[depth:]
+                parent = stack[-1] if stack else None
+                children.setdefault(parent, set()).add(taxid)
+                stack.append(taxid)
 
-def run_search(bucket: str, database: str, datadir: str, fasta: str, outputdir: str, verbose=False):
+    total = sum(taxa[t]['clade'] for t in children.get(None, []))
+    with open(outfile, 'w') as out:
+        def write_taxon(taxid):
+            t = taxa[taxid]
+            print(f"{100 * t['clade'] / total if total else 0:.4f}\t{t['clade']}\t{t['taxon']}\t{t['rank']}\t{taxid}\t" +
+                  f"{'  ' * t['depth']}{t['name']}", file=out)
+            for c in sorted(children.get(taxid, []), key=lambda x: -taxa[x]['clade']):
+                write_taxon(c)
+
+        # unclassified (taxid 0) comes first, then the tree from root
+        for t in sorted(children.get(None, []), key=lambda x: (x != '0', -taxa[x]['clade'])):
+            write_taxon(t)
+
+
+def merge_tophit_report(reports: list, tophit_aln: str, outfile: str):
+    """
+    Merge the tophit reports. The merged tophit alignments have the top hit for every query, so we
+    recalculate the statistics for each target from them: the number of sequences, the unique coverage
+    (the union of the aligned target intervals / the target length), and the mean identity. The target
+    length, taxid, rank and name come from the shard reports.
+    :param reports: the list of tophit report files
+    :param tophit_aln: the merged tophit alignments
+    :param outfile: the merged report
+    """
+
+    targets = {}
+    for report in reports:
+        with open(report, 'r') as f:
+            for l in f:
+                p = l.rstrip('\n').split('\t')
+                if len(p) < 8:
+                    continue
+                targets[p[0]] = {'length': int(p[3]), 'rest': p[5:]}
+
+    intervals = {}
+    identity = {}
+    with open(tophit_aln, 'r') as f:
+        for l in f:
+            p = l.rstrip('\n').split('\t')
+            if len(p) < 12:
+                continue
+            tstart, tend = int(p[8]), int(p[9])
+            intervals.setdefault(p[1], []).append((min(tstart, tend), max(tstart, tend)))
+            identity[p[1]] = identity.get(p[1], 0.0) + float(p[2])
+
+    with open(outfile, 'w') as out:
+        for target in sorted(intervals, key=lambda x: -len(intervals[x])):
+            if target not in targets:
+                print(f"WARNING: {target} is in {tophit_aln} but not in the tophit reports", file=sys.stderr)
+                continue
+            covered = 0
+            last = 0
+            for start, end in sorted(intervals[target]):
+                start = max(start, last + 1)
+                if end >= start:
+                    covered += end - start + 1
+                    last = end
+            n = len(intervals[target])
+            print("\t".join([target, str(n), f"{covered / targets[target]['length']:.3f}",
+                             str(targets[target]['length']), f"{identity[target] / n:.3f}"] +
+                            targets[target]['rest']), file=out)
+
+
+def read_manifest(outputdir: str) -> int:
+    """
+    Read the number of shards split_fasta made
+    :param outputdir: the output prefix
+    :return: the number of shards
+    """
+    manifest = f"{outputdir}_shards/manifest.tsv"
+    if not os.path.exists(manifest):
+        print(f"ERROR: {manifest} not found. Did the shards run?", file=sys.stderr)
+        sys.exit(2)
+    with open(manifest, 'r') as f:
+        return sum(1 for l in f) - 1
+
+
+def merge_shards(outputdir: str, verbose=False):
+    """
+    Merge the shard outputs into {outputdir}_lca.tsv, _report, _tophit_aln and _tophit_report
+    :param outputdir: the output prefix
+    :param verbose: more output
+    """
+
+    shards = read_manifest(outputdir)
+    prefixes = [f"{outputdir}_shards/shard_{i}" for i in range(shards)]
+    missing = [p for p in prefixes if not os.path.exists(f"{p}.done")]
+    if missing:
+        print(f"ERROR: no complete results for {' '.join(missing)}. Not merging", file=sys.stderr)
+        sys.exit(2)
+
+    # the lca and the alignments are one line per query, so we just concatenate them
+    for suffix in ['_lca.tsv', '_tophit_aln']:
+        with open(f"{outputdir}{suffix}", 'wb') as out:
+            for p in prefixes:
+                if os.path.exists(f"{p}{suffix}"):
+                    with open(f"{p}{suffix}", 'rb') as f:
+                        shutil.copyfileobj(f, out)
+
+    merge_report([f"{p}_report" for p in prefixes if os.path.exists(f"{p}_report")], f"{outputdir}_report")
+    merge_tophit_report([f"{p}_tophit_report" for p in prefixes if os.path.exists(f"{p}_tophit_report")],
+                        f"{outputdir}_tophit_aln", f"{outputdir}_tophit_report")
+    if verbose:
+        print(f"Merged {shards} shards into {outputdir}", file=sys.stderr)
+
+
+def tsv_to_parquet(tsvfile: str, parquetfile: str, columns: list, block_size: int = 64 * 1024 * 1024,
+                   verbose=False):
+    """
+    Stream a tsv file into a parquet file, one block at a time
+    :param tsvfile: the tsv file to read
+    :param parquetfile: the parquet file to write
+    :param columns: a list of (name, type) tuples for the columns we know about
+    :param block_size: the number of bytes to read in each block. This bounds the memory we use
+    :param verbose: more output
+    :return: the number of rows written
+    """
+
+    # the number of columns depends on the mmseqs options, so check the first line
+    with open(tsvfile, 'r') as f:
+        ncols = len(f.readline().rstrip('\n').split('\t'))
+    columns = columns[:ncols] + [(f"column_{i}", pa.string()) for i in range(len(columns), ncols)]
+
+    reader = pacsv.open_csv(
+        tsvfile,
+        read_options=pacsv.ReadOptions(column_names=[c[0] for c in columns], block_size=block_size),
+        parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pacsv.ConvertOptions(column_types=dict(columns), strings_can_be_null=False)
+    )
+    rows = 0
+    with pq.ParquetWriter(parquetfile, reader.schema, compression='zstd') as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+
+    if verbose:
+        print(f"Converted {rows} rows from {tsvfile} to {parquetfile}", file=sys.stderr)
+    return rows
+
+
+def convert_outputs(outputdir: str, verbose=False):
+    """
+    Convert the mmseqs outputs to parquet
+    :param outputdir: the output prefix we gave to mmseqs
+    :param verbose: more output
+    :return: a list of the parquet files we wrote
+    """
+
+    parquetfiles = []
+    for suffix, columns in OUTPUT_COLUMNS.items():
+        tsvfile = f"{outputdir}{suffix}"
+        if not os.path.exists(tsvfile) or os.path.getsize(tsvfile) == 0:
+            if verbose:
+                print(f"No results in {tsvfile}. Not converting", file=sys.stderr)
+            continue
+        parquetfile = f"{outputdir}{suffix.replace('.tsv', '')}.parquet"
+        tsv_to_parquet(tsvfile, parquetfile, columns, verbose=verbose)
+        parquetfiles.append(parquetfile)
+    return parquetfiles
+
+
+def upload_outputs(files: list, location: str, s3_client: BaseClient, verbose=False):
+    """
+    Upload files to acacia. upload_file uses multipart uploads so we don't read the whole file into memory
+    :param files: the list of files to upload
+    :param location: the bucket and path to upload to, e.g. results/mmseqs/sample1
+    :param s3_client: the connection to s3
+    :param verbose: more output
+    """
+
+    bucket_name, _, prefix = location.partition('/')
+    for f in files:
+        key = f"{prefix.rstrip('/')}/{os.path.basename(f)}" if prefix else os.path.basename(f)
+        if verbose:
+            print(f"Uploading {f} to {bucket_name}/{key}", file=sys.stderr)
+        s3_client.upload_file(f, bucket_name, key)
+
+
+def run_search(bucket: str, database: str, datadir: str, fasta: str, outputdir: str, parquet=False,
+               upload=None, shards=1, shard_index=None, merge_only=False, stage_only=False, threads=8,
+               tmpdir="/home/edwa0468/scratch/tmp/", verbose=False):
     """
     Run the search
     :param bucket: where the data resides
     :param database: the name of the database
     :param datadir: the directory to put the named pipes in
     :param fasta: the fasta file to compare
-    :param s3_client: the S3 client
+    :param outputdir: the output prefix for mmseqs
+    :param parquet: convert the outputs to parquet
+    :param upload: the location on acacia to upload the parquet files to
+    :param shards: split the fasta into this many shards and run them at the same time
+    :param shard_index: only run this shard (e.g. an array job task)
+    :param merge_only: just merge the shard outputs
+    :param stage_only: just stage the database (run this once before the array tasks)
+    :param threads: the number of threads for each mmseqs
+    :param tmpdir: the directory for the mmseqs tmp directories
     :param verbose: more output
     :return:
     """
 
+    if stage_only:
+        os.makedirs(datadir, exist_ok=True)
+        stage_database(bucket, database, datadir, get_s3client(), verbose)
+        return
+
+    if shards > 1:
+        if not merge_only:
+            if shard_index is None and not database_staged(database, datadir):
+                os.makedirs(datadir, exist_ok=True)
+                stage_database(bucket, database, datadir, get_s3client(), verbose)
+            elif not database_staged(database, datadir):
+                print(f"ERROR: {database} is not staged in {datadir}. Run with --stage first", file=sys.stderr)
+                sys.exit(2)
+            shardfiles = split_fasta(fasta, shards, f"{outputdir}_shards", shard_index, verbose)
+            if shard_index is not None and shard_index >= len(shardfiles):
+                print(f"There are only {len(shardfiles)} shards, so shard {shard_index} has nothing to do",
+                      file=sys.stderr)
+                return
+            failed = run_shards(datadir, database, shardfiles, outputdir, threads, tmpdir, shard_index, verbose)
+            if failed:
+                print(f"ERROR: shards {' '.join(map(str, failed))} failed. Not merging", file=sys.stderr)
+                sys.exit(2)
+        if shard_index is not None:
+            return
+        merge_shards(outputdir, verbose)
+        if parquet or upload:
+            parquetfiles = convert_outputs(outputdir, verbose)
+            if upload:
+                upload_outputs(parquetfiles, upload, get_s3client(), verbose)
+        return
+
     if verbose:
         print("Starting database connections", file=sys.stderr)
     os.makedirs(datadir, exist_ok=True)
@@ -124,10 +579,27 @@ def run_search(bucket: str, database: str, datadir: str, fasta: str, outputdir:
 
     if verbose:
         print("Starting mmseqs", file=sys.stderr)
-    mmseqs = Process(target=run_mmseqs, args=(datadir, database, fasta, outputdir, verbose,))
+    mmseqs = Process(target=run_mmseqs, args=(datadir, database, fasta, outputdir, threads, tmpdir, verbose,))
     mmseqs.start()
     mmseqs.join()
 
+    # check every connection, and stop any that are still running, before we give up on anything
+    failed = [name for name in connections
+              if writer_failed(connections[name]['process'], f"{bucket}/{name}", timeout=60)]
+    if mmseqs.exitcode != 0:
+        print(f"ERROR: mmseqs exited with {mmseqs.exitcode}", file=sys.stderr)
+        sys.exit(2)
+    if failed:
+        print(f"ERROR: streaming {' '.join(failed)} did not finish. The results are not complete", file=sys.stderr)
+        sys.exit(2)
+
+    if parquet or upload:
+        if verbose:
+            print("Converting the outputs to parquet", file=sys.stderr)
+        parquetfiles = convert_outputs(outputdir, verbose)
+        if upload:
+            upload_outputs(parquetfiles, upload, get_s3client(), verbose)
+
     print("*************WE GOT TO THE END*************")
     print("*************WE GOT TO THE END*************", file=sys.stderr)
     # for name in connections:
@@ -135,13 +607,32 @@ def run_search(bucket: str, database: str, datadir: str, fasta: str, outputdir:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=' ')
-    parser.add_argument('-f', help='fasta file', required=True)
+    parser.add_argument('-f', help='fasta file')
     parser.add_argument('-o', help='output directory', required=True)
     parser.add_argument('-m', help='mmseqs database', default="UniRef50")
     parser.add_argument('-b', help='bucket name on acacia', default="databases/mmseqs/UniRef50.20230126")
     parser.add_argument('-d', help='datadirectory for connections', default='uniref')
+    parser.add_argument('-p', help='convert the outputs to parquet', action='store_true')
+    parser.add_argument('-u', help='upload the parquet files to this location on acacia (implies -p)')
+    parser.add_argument('-s', help='split the fasta into this many shards and run them at the same time', type=int,
+                        default=1)
+    parser.add_argument('-i', help='only run this shard (e.g. $SLURM_ARRAY_TASK_ID)', type=int)
+    parser.add_argument('--merge', help='just merge the shard outputs', action='store_true')
+    parser.add_argument('--stage', help='just stage the database (once, before the array tasks)', action='store_true')
+    parser.add_argument('-t', help='threads for each mmseqs (default: 8)', type=int, default=8)
+    parser.add_argument('--tmp', help='directory for the mmseqs tmp directories', default="/home/edwa0468/scratch/tmp/")
 
     parser.add_argument('-v', help='verbose output', action='store_true')
     args = parser.parse_args()
 
-    run_search(args.b, args.m, args.d, args.f, args.o, args.v)
+    if args.i is not None and args.merge:
+        parser.error('-i runs one shard and --merge merges them all, so use them separately')
+    if (args.i is not None or args.merge) and args.s < 2:
+        parser.error('-i and --merge need -s with more than one shard')
+    if args.i is not None and not 0 <= args.i < args.s:
+        parser.error(f'-i must be between 0 and {args.s - 1}')
+    if not (args.f or args.merge or args.stage):
+        parser.error('-f is required unless you use --merge or --stage')
+
+    run_search(args.b, args.m, args.d, args.f, args.o, parquet=args.p, upload=args.u, shards=args.s,
+               shard_index=args.i, merge_only=args.merge, stage_only=args.stage, threads=args.t, tmpdir=args.tmp, verbose=args.v)